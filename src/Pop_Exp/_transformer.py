@@ -0,0 +1,12 @@
+from functools import lru_cache
+from pyproj import Transformer
+
+
+# building a pyproj Transformer means constructing a PROJ pipeline, which
+# costs ~20ms each time. the hazard pipeline hits the same (source, target)
+# CRS pairs over and over (WGS84 <-> a handful of UTM zones), so cache the
+# transformers and hand back the same object for repeated pairs.
+# always_xy=True so coordinates are (lon, lat) ordered like our geometries.
+@lru_cache(maxsize=64)
+def cached_transformer(src_crs, dst_crs):
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
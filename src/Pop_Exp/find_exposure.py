@@ -2,16 +2,30 @@ import pandas as pd
 import geopandas as gpd
 import numpy as np
 import pyarrow.parquet as pq
+import pyogrio
 import rasterio
 import rasterio.windows
 from tqdm import tqdm
-from shapely.validation import make_valid
+import shapely
 from shapely.ops import unary_union
-from shapely import wkt
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from exactextract import exact_extract
+from ._transformer import cached_transformer
+import hashlib
+import json
+import os
 import warnings
 
+# dask-geopandas is optional (pip install Pop_Exp[dask]): when present, big
+# buffering jobs are partitioned across cores
+try:
+    import dask_geopandas
+except ImportError:
+    dask_geopandas = None
+
 warnings.filterwarnings("ignore")
 # just here to stop the script complaining about how we're taking centroids
 # in a projected instead of geographic crs
@@ -25,6 +39,15 @@ def get_best_utm_projection(lat, lon):
     return f"EPSG:{int(epsg_code)}"
 
 
+# same thing for whole arrays at once: take lat and lon arrays and return an
+# int array of the best UTM EPSG code for each pair, in a few numpy ufunc
+# calls instead of one python call per pair
+def get_best_utm_projection_vec(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    zone_number = ((lon + 180) // 6 + 1).astype(int)
+    hemisphere = np.where(lat >= 0, 32600, 32700)
+    return hemisphere + zone_number
+
+
 # add UTM projection column to a geodataframe initially only containing
 # climate hazard IDs, a buffer distance column, and a geometry column.
 # this column will contain the best UTM projection for the centroid of each
@@ -40,34 +63,62 @@ def get_best_utm_projection(lat, lon):
 # also note centroid for points is just the point itself
 def add_utm_projection(ch_shp: gpd.GeoDataFrame):
 
-    # get lat and lon
-    ch_shp["centroid_lon"] = ch_shp.centroid.x
-    ch_shp["centroid_lat"] = ch_shp.centroid.y
+    # get lat and lon as plain numpy arrays
+    centroids = ch_shp.centroid
+    lon = centroids.x.to_numpy()
+    lat = centroids.y.to_numpy()
 
-    # get projection for each hazard
-    ch_shp["utm_projection"] = ch_shp.apply(
-        lambda row: get_best_utm_projection(
-            lat=row["centroid_lat"], lon=row["centroid_lon"]
-        ),
-        axis=1,
-    )
+    # get projection for each hazard, all at once instead of row by row.
+    # kept as raw int32 EPSG codes: grouping on ints is much faster than on
+    # "EPSG:xxxxx" strings, and pyproj takes the codes directly
+    ch_shp["utm_epsg"] = get_best_utm_projection_vec(lat, lon).astype(np.int32)
 
     # select id, geometry, buffer dist, and utm projection
-    ch_shp = ch_shp[["ID_climate_hazard", "buffer_dist", "geometry", "utm_projection"]]
+    ch_shp = ch_shp[["ID_climate_hazard", "buffer_dist", "geometry", "utm_epsg"]]
 
     return ch_shp
 
 
+# read a geoparquet file with the geometry decoded in bulk.
+# the dominant cost of reading WKB-encoded geoparquet is turning the WKB
+# column into shapely geometries, so pull the raw binary column out of the
+# arrow table and decode it with a single vectorized shapely.from_wkb call,
+# converting the attribute columns separately. anything that isn't plain
+# WKB geoparquet falls back to gpd.read_parquet, which handles it fine
+def _load_geoparquet(path, columns: list = None) -> gpd.GeoDataFrame:
+    table = pq.read_table(path, columns=columns)
+    geo_meta = (table.schema.metadata or {}).get(b"geo")
+    if geo_meta is None:
+        return gpd.read_parquet(path, columns=columns)
+    geo_meta = json.loads(geo_meta)
+    geom_col = geo_meta.get("primary_column", "geometry")
+    col_meta = geo_meta.get("columns", {}).get(geom_col, {})
+    if col_meta.get("encoding") != "WKB" or geom_col not in table.column_names:
+        return gpd.read_parquet(path, columns=columns)
+
+    # decode all geometries in one pass over the contiguous WKB buffer
+    geoms = shapely.from_wkb(table.column(geom_col).to_numpy(zero_copy_only=False))
+    # geoparquet stores the crs as PROJJSON; missing means lon/lat WGS84
+    crs = col_meta.get("crs") or "OGC:CRS84"
+    attributes = table.drop_columns([geom_col]).to_pandas()
+
+    return gpd.GeoDataFrame(attributes, geometry=geoms, crs=crs)
+
+
 # read in a geo data file from either parquet or geojson
-def load_ch(path_to_hazard: str) -> gpd.GeoDataFrame:
+# columns optionally limits which attribute columns are materialized
+def load_ch(path_to_hazard: str, columns: list = None) -> gpd.GeoDataFrame:
     """Function to load data"""
     path = Path(path_to_hazard)
 
     # Check the file extension
     if path.suffix == ".geojson":
-        data = gpd.read_file(path)
+        # pyogrio with arrow reads columns in bulk instead of building one
+        # python object per feature, which is much faster than the old
+        # fiona-backed gpd.read_file
+        data = pyogrio.read_dataframe(path, columns=columns, use_arrow=True)
     elif path.suffix == ".parquet":
-        data = gpd.read_parquet(path)
+        data = _load_geoparquet(path, columns=columns)
     else:
         raise FileNotFoundError(f"File not found or unsupported file type: {path}")
 
@@ -95,10 +146,17 @@ def prep_geographies(shp_path: str, geo_type: str):
     shp_df = load_ch(shp_path)
 
     # remove missing geoms
-    shp_df = shp_df[~shp_df["geometry"].is_empty]
-
-    # make valid geoms, esp important for hazards
-    shp_df["geometry"] = shp_df["geometry"].apply(make_valid)
+    shp_df = shp_df[~shapely.is_empty(shp_df["geometry"].values)]
+
+    # make valid geoms, esp important for hazards. checking validity is much
+    # cheaper than repairing, and curated inputs are mostly valid already, so
+    # run vectorized is_valid first and only make_valid the failures
+    geoms = np.asarray(shp_df["geometry"].values)
+    invalid = ~shapely.is_valid(geoms)
+    if invalid.any():
+        geoms = geoms.copy()
+        geoms[invalid] = shapely.make_valid(geoms[invalid])
+        shp_df["geometry"] = geoms
 
     # reproject to WGS84
     if shp_df.crs != "EPSG:4326":
@@ -111,35 +169,96 @@ def prep_geographies(shp_path: str, geo_type: str):
     return shp_df
 
 
+# reproject an array of geometries between two CRSs by running their
+# coordinate arrays through a cached pyproj transformer. this skips the
+# GeoSeries + CRS normalization + transformer build that to_crs does on
+# every call, which matters when buffering visits many small UTM groups
+def _reproject_geoms(geoms, src_crs, dst_crs):
+    transformer = cached_transformer(src_crs, dst_crs)
+    return shapely.transform(
+        geoms,
+        lambda coords: np.column_stack(
+            transformer.transform(coords[:, 0], coords[:, 1])
+        ),
+    )
+
+
+# buffer a projected GeoSeries by per-row distances in meters.
+# buffering is the compute-heavy part of prep, and each geometry is
+# independent, so when dask-geopandas is installed and the group is big
+# enough to be worth it, partition the rows across cores and buffer each
+# partition in parallel (GEOS releases the GIL). otherwise one vectorized
+# buffer call
+def _buffer_geoms(geoms_utm: gpd.GeoSeries, buffer_dists: np.ndarray):
+    if dask_geopandas is None or len(geoms_utm) < 512:
+        return geoms_utm.buffer(buffer_dists)
+
+    parts = dask_geopandas.from_geopandas(
+        gpd.GeoDataFrame({"geometry": geoms_utm, "buffer_dist": buffer_dists}),
+        npartitions=os.cpu_count(),
+    )
+    buffered = parts.map_partitions(
+        lambda part: part.geometry.buffer(part["buffer_dist"].to_numpy()),
+        meta=gpd.GeoSeries([], crs=geoms_utm.crs),
+    ).compute()
+    return buffered.set_crs(geoms_utm.crs, allow_override=True)
+
+
 # mutate a dataframe containing climate hazards: buffer each climate hazard
 # geometry, based on the existing column 'buffer_dist', and add new col
 # containing a new buffered hazard geometry
 def add_buffered_geom_col(ch_df: gpd.GeoDataFrame):
-    for index, row in tqdm(
-        ch_df.iterrows(), total=len(ch_df), desc="Buffering hazard geometries (2/3)"
-    ):
-        best_utm = row["utm_projection"]
-        hazard_geom = row["geometry"]
-
-        # create geoseries in best projection
-        geom_series = gpd.GeoSeries([hazard_geom], crs=ch_df.crs)
-        geom_series_utm = geom_series.to_crs(best_utm)
-
-        # buffer distance is in meters
-        buffer_dist = row["buffer_dist"]
-        buffered_hazard_geometry = geom_series_utm.buffer(buffer_dist).iloc[0]
-        # back to OG
-        buffered_hazard_geometry = (
-            gpd.GeoSeries([buffered_hazard_geometry], crs=best_utm)
-            .to_crs(ch_df.crs)
-            .iloc[0]
+    ch_df["buffered_hazard"] = None
+    # group hazards sharing a UTM projection so each group is reprojected and
+    # buffered in one vectorized call, instead of paying the transformer setup
+    # cost once per hazard
+    groups = ch_df.groupby("utm_epsg").groups
+
+    # reproject a group into its best projection, buffer (distances are in
+    # meters), and reproject back. best_utm is an int EPSG code
+    def buffer_group(best_utm, idx):
+        sub = ch_df.loc[idx]
+        geoms_utm = _reproject_geoms(sub.geometry.values, ch_df.crs, best_utm)
+        buffered = _buffer_geoms(
+            gpd.GeoSeries(geoms_utm, index=sub.index, crs=best_utm),
+            sub["buffer_dist"].to_numpy(),
         )
-        # add
-        ch_df.at[index, "buffered_hazard"] = buffered_hazard_geometry
+        return _reproject_geoms(buffered.values, best_utm, ch_df.crs)
+
+    # each UTM group is independent, and GEOS buffering and pyproj transforms
+    # both release the GIL, so run the groups on a thread pool. results are
+    # written back on the main thread as they finish
+    n_workers = min(os.cpu_count() or 1, len(groups))
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        futures = {
+            executor.submit(buffer_group, int(best_utm), idx): idx
+            for best_utm, idx in groups.items()
+        }
+        for future in tqdm(
+            as_completed(futures),
+            total=len(futures),
+            desc="Buffering hazard geometries (2/3)",
+        ):
+            ch_df.loc[futures[future], "buffered_hazard"] = future.result()
+
+    # store the buffered geoms as a real geometry column rather than an
+    # object column, so the frame can round-trip through parquet
+    ch_df["buffered_hazard"] = gpd.GeoSeries(
+        ch_df["buffered_hazard"], index=ch_df.index, crs=ch_df.crs
+    )
 
     return ch_df
 
 
+# cache file for a prepped hazard frame: keyed on the input path and its
+# mtime, so editing or replacing the hazard file invalidates the cache
+def _prep_cache_path(cache_dir: str, path_to_hazards: str) -> Path:
+    key = hashlib.blake2s(
+        (str(path_to_hazards) + str(os.path.getmtime(path_to_hazards))).encode()
+    ).hexdigest()
+    return Path(cache_dir) / f"{key}.parquet"
+
+
 # prep data: this function takes in path names to climate hazards and
 # optionally to additional geographies, and calls the above helpers to read
 # in data, find best UTM crs for each climate hazard, and buffer the hazards.
@@ -147,21 +266,34 @@ def add_buffered_geom_col(ch_df: gpd.GeoDataFrame):
 # best UTM projection, buffer distance, and buffered hazard geometry. if there
 # are additional geos, it returns a tuple of the above plus a dataframe
 # containing the additional geo IDs and geometries.
+# ------------------------------------------------------------------------
+# prepping is deterministic given the input file but expensive (UTM lookup
+# plus buffering), so if cache_dir is passed, the prepped hazard frame is
+# written there as geoarrow parquet and reruns on the same unchanged input
+# are just a parquet load
 def prep_data(
     path_to_hazards: str,
     path_to_additional_geos: str = None,
+    cache_dir: str = None,
 ):
 
-    # prep both geographies
-    ch_shp = prep_geographies(path_to_hazards, geo_type="hazard")
-    # if additional_geos isn't None, do this step too
-    if path_to_additional_geos:
-        ad_geo = prep_geographies(path_to_additional_geos, geo_type="spatial_unit")
-
-    # add buffered hazard geometry col to climate hazards
-    ch_shp = add_buffered_geom_col(ch_shp)
+    cache_path = None
+    if cache_dir:
+        cache_path = _prep_cache_path(cache_dir, path_to_hazards)
 
+    if cache_path is not None and cache_path.exists():
+        ch_shp = gpd.read_parquet(cache_path)
+    else:
+        # prep hazards and add buffered hazard geometry col
+        ch_shp = prep_geographies(path_to_hazards, geo_type="hazard")
+        ch_shp = add_buffered_geom_col(ch_shp)
+        if cache_path is not None:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            ch_shp.to_parquet(cache_path, geometry_encoding="geoarrow")
+
+    # if additional_geos isn't None, prep those too
     if path_to_additional_geos:
+        ad_geo = prep_geographies(path_to_additional_geos, geo_type="spatial_unit")
         return ch_shp, ad_geo
     else:
         return ch_shp
@@ -175,8 +307,7 @@ def prep_data(
 # untouched. return a dataframe of new unioned geometries and their IDs
 # IDs will have the same name as the input ID column, geom called 'geometry'
 # ------------------------------------------------------------------------
-# this function is hacky. if anyone has ideas to improve please!
-# also there is some complexity. in the test dataset sometimes there is one
+# there is some complexity. in the test dataset sometimes there is one
 # fire that is two geometries combined. in that case, this function first splits
 # those up into two geometries both with the same ID, and then finds geometries
 # that overlap with those invididually.
@@ -190,48 +321,71 @@ def prep_data(
 # one group of fires/hazards
 def combine_overlapping_geometries(ch_df: gpd.GeoDataFrame, id_column: str):
     # step 1: explode the data
-    # step 2: unary union the data
-    # step 3: explode again
-    # step 4: rejoin names
+    # step 2: find groups of overlapping geometries with a spatial index
+    # step 3: union each group of overlapping geometries
+    # step 4: concatenate the IDs of each group
 
     # expand data frame to climate hazards that are not overlapping
-    ch_df = ch_df.explode()
+    ch_df = ch_df.explode(ignore_index=True)
+
+    geoms = ch_df["geometry"].values
+    ids = ch_df[id_column].to_numpy()
+
+    # build a spatial index over all geometries, and query it against itself
+    # to get every pair of geometries that intersect (bounding box prefilter
+    # plus exact intersects test, all in GEOS)
+    tree = shapely.STRtree(geoms)
+    left, right = tree.query(geoms, predicate="intersects")
+
+    # treat those pairs as edges of a graph, and find its connected
+    # components: each component is one group of transitively-overlapping
+    # hazards. geometries that overlap nothing end up in their own component
+    n = len(geoms)
+    adjacency = coo_matrix((np.ones(len(left), dtype=bool), (left, right)), shape=(n, n))
+    n_components, labels = connected_components(adjacency, directed=False)
+
+    # union each multi-member component; singleton components are untouched,
+    # which skips the expensive union work entirely for disjoint hazards
+    combined_ids = []
+    combined_geometries = []
+    for component in range(n_components):
+        members = np.flatnonzero(labels == component)
+        combined_ids.append("___".join(ids[members]))
+        if len(members) == 1:
+            combined_geometries.append(geoms[members[0]])
+        else:
+            combined_geometries.append(unary_union(geoms[members]))
+
+    combined_geoms = gpd.GeoDataFrame(
+        {id_column: combined_ids, "geometry": combined_geometries}, crs=ch_df.crs
+    )
 
-    # get unary union of all geometries in the dataset
-    all_one_geometry = unary_union(ch_df["geometry"])
+    return combined_geoms
 
-    # get non-overlapping hazards by exploding all_one_geometry
-    non_overlapping_hazards = gpd.GeoDataFrame(
-        {"geometry": [all_one_geometry]}, crs=ch_df.crs
-    ).explode()
 
-    # rejoin IDs
-    # join the IDs back to the non-overlapping hazards
-    joined = gpd.sjoin(
-        non_overlapping_hazards, ch_df, how="left", predicate="intersects"
-    )
+# run exact_extract over the geometries of ch_df and return the per-feature
+# sums. exact_extract is vectorized across features but runs on one core;
+# its C++ extraction releases the GIL, so for large frames we split the rows
+# into one chunk per core and extract the chunks on a thread pool (each call
+# opens its own raster handle from the path, so the reads are independent).
+# small frames aren't worth the thread overhead and stay serial
+def _exact_extract_sums(ch_df: gpd.GeoDataFrame, raster_path: str):
+    # ask exact_extract for a dataframe back, so the sums come out as one
+    # numpy column instead of a geojson-style dict per feature
+    def extract(rows):
+        return exact_extract(raster_path, rows, "sum", output="pandas")[
+            "sum"
+        ].to_numpy()
 
-    # drop geometry to group by that column
-    joined["geometry_wkt"] = joined["geometry"].apply(lambda geom: geom.wkt)
-    without_geom = joined.drop(columns="geometry")
+    n_workers = min(os.cpu_count() or 1, len(ch_df) // 64)
+    if n_workers <= 1:
+        return extract(ch_df)
 
-    # group by geometry_wkt, and aggregate by concatenating the
-    # ID_climate_hazard into one string
-    without_geom = (
-        without_geom.groupby("geometry_wkt")
-        .agg({id_column: lambda x: "___".join(x)})
-        .reset_index()
-    )
-    # add back geoms
-    combined_geoms = gpd.GeoDataFrame(
-        without_geom,
-        geometry=without_geom["geometry_wkt"].apply(wkt.loads),
-        crs=ch_df.crs,
-    )
-    # select id and geometry and name right
-    combined_geoms = combined_geoms[[id_column, "geometry"]]
+    chunks = np.array_split(np.arange(len(ch_df)), n_workers)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        parts = executor.map(lambda idx: extract(ch_df.iloc[idx]), chunks)
 
-    return combined_geoms
+    return np.concatenate(list(parts))
 
 
 # mask raster partial pixel: this function mutates a dataframe to add
@@ -243,23 +397,23 @@ def combine_overlapping_geometries(ch_df: gpd.GeoDataFrame, id_column: str):
 # 'num_people_affected'.
 def mask_raster_partial_pixel(ch_df: gpd.GeoDataFrame, raster_path: str):
     print("Masking raster: 3/3")
-    # Open the raster file
+    # Open the raster just to read its CRS - this is a metadata read, the
+    # pixels are only touched by exact_extract below. exactextract warns on
+    # a CRS mismatch but does not reproject, so alignment is still on us,
+    # but we only pay for a reprojection when the CRS actually differs
     with rasterio.open(raster_path) as src:
-        # Ensure CRS alignment
-        if ch_df.crs != src.crs:
-            ch_df = ch_df.to_crs(src.crs)
-
-    # Use exact_extract to calculate population sums for each geometry
-    # it returns a dictionary so we need to get out the right stuff
-    num_people_affected = exact_extract(
-        raster_path,
-        ch_df,
-        "sum",
-    )
-    sums = [hazard["properties"]["sum"] for hazard in num_people_affected]
-    ch_df["num_people_affected"] = sums
-    # project ch_df back to wgs84
-    ch_df = ch_df.to_crs("EPSG:4326")
+        raster_crs = src.crs
+    if ch_df.crs != raster_crs:
+        ch_df = ch_df.to_crs(raster_crs)
+
+    # Use exact_extract to calculate population sums for each geometry,
+    # chunked across threads for large frames
+    ch_df["num_people_affected"] = _exact_extract_sums(ch_df, raster_path)
+    # project ch_df back to wgs84, but only if the raster pulled it into a
+    # different CRS - in the usual all-WGS84 case this whole function now
+    # does no reprojection at all
+    if ch_df.crs != "EPSG:4326":
+        ch_df = ch_df.to_crs("EPSG:4326")
 
     # final df
     return ch_df
@@ -327,7 +481,39 @@ def find_num_people_affected_by_geo(
     # intersecting w each buffered hazard
     # set active geom to buffered hazard
     ch_shp = ch_shp.set_geometry("geometry", crs="EPSG:4326")
-    unit_hazard_intersection = gpd.overlay(ch_shp, ad_geo, how="intersection")
+    # instead of gpd.overlay: an STRtree query prunes the hazard/unit pairs
+    # down to ones whose boxes intersect, then one vectorized
+    # shapely.intersection call cuts all the pieces at once
+    tree = shapely.STRtree(ad_geo.geometry.values)
+    hazard_idx, unit_idx = tree.query(ch_shp.geometry.values, predicate="intersects")
+    pieces = shapely.intersection(
+        ch_shp.geometry.values[hazard_idx], ad_geo.geometry.values[unit_idx]
+    )
+    # drop pieces with no area (hazards that only touch a unit boundary),
+    # which is what overlay's keep_geom_type did
+    has_area = shapely.get_dimensions(pieces) == 2
+    pieces = pieces[has_area]
+    # a piece can still be a mixed GeometryCollection - a polygon overlap
+    # plus a shared boundary segment, e.g. when a zero-buffer hazard traces
+    # the same lines as a unit. exact_extract rejects mixed-type geometries,
+    # and overlay kept only the polygonal parts, so reduce collections to
+    # the union of their area parts
+    collections = shapely.get_type_id(pieces) == 7
+    if collections.any():
+        pieces[collections] = [
+            unary_union(parts[shapely.get_dimensions(parts) == 2])
+            for parts in (shapely.get_parts(geom) for geom in pieces[collections])
+        ]
+    unit_hazard_intersection = gpd.GeoDataFrame(
+        {
+            "ID_climate_hazard": ch_shp["ID_climate_hazard"].to_numpy()[hazard_idx][
+                has_area
+            ],
+            "ID_spatial_unit": ad_geo["ID_spatial_unit"].to_numpy()[unit_idx][has_area],
+        },
+        geometry=pieces,
+        crs=ch_shp.crs,
+    )
 
     # find num of people affected by each piece
     num_af = mask_raster_partial_pixel(unit_hazard_intersection, raster_path)